@@ -1,9 +1,8 @@
 from math import sqrt
 import torch
-from torch import nn, einsum
+from torch import nn
 import torch.nn.functional as F
 
-from einops import rearrange
 from x_transformers import Encoder, Decoder
 
 # helpers
@@ -15,8 +14,15 @@ def is_empty(t):
     return t.nelement() == 0
 
 def masked_mean(t, mask, dim = 1):
-    t = t.masked_fill(~mask[:, :, None], 0.)
-    return t.sum(dim = 1) / mask.sum(dim = 1)[..., None]
+    mask = mask.to(t.dtype)
+    numer = (mask[:, None, :] @ t).squeeze(1) # batched (1, n) @ (n, d) sums only the unmasked positions
+    denom = mask.sum(dim = 1, keepdim = True).clamp(min = 1.)
+    return numer / denom
+
+def compile_module(module):
+    assert hasattr(module, 'compile'), 'compiling requires pytorch 2.2 or above'
+    module.compile(dynamic = True) # in place, so state dict keys are unchanged. dynamic, as sequence lengths vary between calls
+    return module
 
 def eval_decorator(fn):
     def inner(model, *args, **kwargs):
@@ -29,13 +35,17 @@ def eval_decorator(fn):
 
 # sampling helpers
 
-def top_k(logits, thres = 0.5):
+def top_k(logits, thres: float = 0.5):
     num_logits = logits.shape[-1]
     k = max(int((1 - thres) * num_logits), 1)
-    val, ind = torch.topk(logits, k)
-    probs = torch.full_like(logits, float('-inf'))
-    probs.scatter_(1, ind, val)
-    return probs
+    val, _ = torch.topk(logits, k)
+    kth_val = val[..., -1:]
+    return logits.masked_fill(logits < kth_val, float('-inf'))
+
+def gumbel_sample(logits, temperature = 1.):
+    # gumbel-max trick, samples the same categorical as softmax + multinomial, without leaving the device
+    gumbel_noise = -torch.empty_like(logits).exponential_().log()
+    return ((logits / temperature) + gumbel_noise).argmax(dim = -1, keepdim = True)
 
 # discrete vae class
 
@@ -46,12 +56,21 @@ class DiscreteVAE(nn.Module):
         dim = 512,
         hidden_dim = 64,
         num_layers = 3,
-        channels = 3
+        channels = 3,
+        straight_through = False,
+        image_size = None
     ):
         super().__init__()
         hdim = hidden_dim
         
         assert num_layers >= 1
+
+        # each encoder layer halves the resolution, so the token feature map size is known up front if the image size is
+
+        self.fmap_size = None
+        if exists(image_size):
+            assert (image_size % (2 ** num_layers)) == 0, 'image size must be divisible by 2 ** num_layers'
+            self.fmap_size = image_size // (2 ** num_layers)
         
         encoder_layers = []
         decoder_layers = []
@@ -71,11 +90,14 @@ class DiscreteVAE(nn.Module):
         encoder_layers.append(nn.Conv2d(hdim, num_tokens, 1))
         decoder_layers.append(nn.Conv2d(hdim, channels, 1))
 
-        self.encoder = nn.Sequential(*encoder_layers)
-        self.decoder = nn.Sequential(*decoder_layers)
+        # conv stacks run in channels last (NHWC), which cudnn has faster kernels for, especially at half precision
+
+        self.encoder = nn.Sequential(*encoder_layers).to(memory_format = torch.channels_last)
+        self.decoder = nn.Sequential(*decoder_layers).to(memory_format = torch.channels_last)
 
         self.num_tokens = num_tokens
         self.codebook = nn.Embedding(num_tokens, dim)
+        self.straight_through = straight_through
 
     @torch.no_grad()
     def get_codebook_indices(self, images):
@@ -89,9 +111,10 @@ class DiscreteVAE(nn.Module):
     ):
         image_embeds = self.codebook(img_seq)
         b, n, d = image_embeds.shape
-        h = w = int(sqrt(n))
+        h = w = self.fmap_size if exists(self.fmap_size) else int(sqrt(n))
+        assert n == h * w, 'sequence length does not match feature map size of the given image_size'
 
-        image_embeds = rearrange(image_embeds, 'b (h w) d -> b d h w', h = h, w = w)
+        image_embeds = image_embeds.view(b, h, w, d).permute(0, 3, 1, 2) # (b, d, h, w) view over the lookup, already in channels last layout
         images = self.decoder(image_embeds)
         return images
 
@@ -101,13 +124,17 @@ class DiscreteVAE(nn.Module):
         return_recon_loss = False,
         return_logits = False
     ):
+        img = img.contiguous(memory_format = torch.channels_last)
         logits = self.encoder(img)
 
         if return_logits:
             return logits # return logits for getting hard image indices for DALL-E training
 
-        soft_one_hot = F.gumbel_softmax(logits, tau = 1.)
-        sampled = einsum('b n h w, n d -> b d h w', soft_one_hot, self.codebook.weight)
+        # gumbel noise is drawn in full precision, then the sample is cast back to the dtype of the logits
+        # with straight through, the sample is a hard one-hot (an exact codebook lookup) that carries the gradients of the relaxed sample
+        soft_one_hot = F.gumbel_softmax(logits.float(), tau = 1., dim = 1, hard = self.straight_through).type_as(logits)
+        codebook_weight = self.codebook.weight.t()[..., None, None] # (n, d) -> (d, n, 1, 1)
+        sampled = F.conv2d(soft_one_hot, codebook_weight)
         out = self.decoder(sampled)
 
         if not return_recon_loss:
@@ -135,7 +162,8 @@ class CLIP(nn.Module):
         visual_image_size = 256,
         visual_patch_size = 32,
         channels = 3,
-        vae = None
+        vae = None,
+        compile_transformer = False
     ):
         super().__init__()
         self.text_emb = nn.Embedding(num_text_tokens, dim_text)
@@ -145,14 +173,17 @@ class CLIP(nn.Module):
 
         assert visual_image_size % visual_patch_size == 0, 'Image dimensions must be divisible by the patch size.'
         num_patches = (visual_image_size // visual_patch_size) ** 2
-        patch_dim = channels * visual_patch_size ** 2
 
         self.visual_patch_size = visual_patch_size
-        self.to_visual_embedding = nn.Linear(patch_dim, dim_image)
+        self.to_visual_embedding = nn.Conv2d(channels, dim_image, visual_patch_size, stride = visual_patch_size) # linear projection of each non-overlapping patch
         self.visual_pos_emb = nn.Embedding(num_patches, dim_image)
         self.visual_transformer = Encoder(dim = dim_image, depth = visual_enc_depth, heads = visual_heads)
         self.to_visual_latent = nn.Linear(dim_image, dim_latent, bias = False)
 
+        if compile_transformer:
+            compile_module(self.text_transformer)
+            compile_module(self.visual_transformer)
+
         self.temperature = nn.Parameter(torch.tensor(1.))
 
         self.vae = vae
@@ -160,6 +191,17 @@ class CLIP(nn.Module):
             self.vae = vae
             self.visual_emb = vae.codebook
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store the patch embedding as a linear over flattened (p1 p2 c) patches, convert it to the conv weight
+        key = f'{prefix}to_visual_embedding.weight'
+        weight = state_dict.get(key)
+
+        if exists(weight) and weight.ndim == 2:
+            p, c = self.visual_patch_size, self.to_visual_embedding.in_channels
+            state_dict[key] = weight.view(weight.shape[0], p, p, c).permute(0, 3, 1, 2)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(
         self,
         text,
@@ -167,17 +209,16 @@ class CLIP(nn.Module):
         text_mask = None,
         return_loss = False
     ):
-        b, device, p = text.shape[0], text.device, self.visual_patch_size
+        b, device = text.shape[0], text.device
 
         if exists(self.vae):
             image = self.vae.get_codebook_indices(image)
 
         text_emb = self.text_emb(text)
-        text_emb += self.text_pos_emb(torch.arange(text.shape[1], device = device))
+        text_emb = text_emb + self.text_pos_emb.weight[:text.shape[1]]
 
-        image_patches = rearrange(image, 'b c (h p1) (w p2) -> b (h w) (p1 p2 c)', p1 = p, p2 = p)
-        image_emb = self.to_visual_embedding(image_patches)
-        image_emb += self.visual_pos_emb(torch.arange(image_emb.shape[1], device = device))
+        image_emb = self.to_visual_embedding(image).flatten(2).transpose(1, 2)
+        image_emb = image_emb + self.visual_pos_emb.weight[:image_emb.shape[1]]
 
         enc_text = self.text_transformer(text_emb, mask = text_mask)
         enc_image = self.visual_transformer(image_emb)
@@ -197,10 +238,10 @@ class CLIP(nn.Module):
         temp = self.temperature.exp()
 
         if not return_loss:
-            sim = einsum('n d, n d -> n', text_latents, image_latents) * temp
+            sim = (text_latents * image_latents).sum(dim = -1).mul_(temp)
             return sim
 
-        sim = einsum('i d, j d -> i j', text_latents, image_latents) * temp
+        sim = (text_latents @ image_latents.t()).mul_(temp)
         labels = torch.arange(b, device = device)
         loss = F.cross_entropy(sim, labels)
         return loss
@@ -217,7 +258,8 @@ class DALLE(nn.Module):
         image_seq_len = 1024,
         depth = 6, # should be 64
         heads = 8,
-        vae = None
+        vae = None,
+        compile_transformer = False
     ):
         super().__init__()
         self.text_emb = nn.Embedding(num_text_tokens, dim)
@@ -242,6 +284,9 @@ class DALLE(nn.Module):
 
         self.transformer = Decoder(dim = dim, depth = depth, heads = heads)
 
+        if compile_transformer:
+            compile_module(self.transformer)
+
         self.to_logits = nn.Sequential(
             nn.LayerNorm(dim),
             nn.Linear(dim, self.total_tokens),
@@ -250,8 +295,8 @@ class DALLE(nn.Module):
         seq_range = torch.arange(seq_len)
         logits_range = torch.arange(total_tokens)
 
-        seq_range = rearrange(seq_range, 'n -> () n ()')
-        logits_range = rearrange(logits_range, 'd -> () () d')
+        seq_range = seq_range.view(1, seq_len, 1)
+        logits_range = logits_range.view(1, 1, total_tokens)
 
         logits_mask = (
             ((seq_range >= (text_seq_len - 1)) & (logits_range < num_text_tokens)) |
@@ -275,23 +320,31 @@ class DALLE(nn.Module):
         text_seq_len, image_seq_len, num_text_tokens = self.text_seq_len, self.image_seq_len, self.num_text_tokens
         total_len = text_seq_len + image_seq_len
 
-        out = text
-        for cur_len in range(text.shape[1], total_len):
+        # sample into a buffer of the full sequence length, rather than growing the sequence (and text mask) every step
+
+        prime_len = text.shape[1]
+        out = text.new_empty((text.shape[0], total_len))
+        out[:, :prime_len] = text
+
+        if exists(mask):
+            mask = F.pad(mask, (0, text_seq_len - mask.shape[1]), value = True)
+
+        cache = None
+
+        for cur_len in range(prime_len, total_len):
             is_image = cur_len >= text_seq_len
 
-            text, image = out[:, :text_seq_len], out[:, text_seq_len:]
+            text, image = out[:, :min(cur_len, text_seq_len)], out[:, text_seq_len:cur_len]
+            text_mask = mask[:, :text.shape[1]] if exists(mask) else None
 
-            logits = self(text, image, mask = mask)[:, -1, :]
+            logits, cache = self(text, image, mask = text_mask, cache = cache, return_cache = True)
+            logits = logits[:, -1, :]
 
             filtered_logits = top_k(logits, thres = filter_thres)
-            probs = F.softmax(filtered_logits / temperature, dim = -1)
-            sample = torch.multinomial(probs, 1)
+            sample = gumbel_sample(filtered_logits, temperature = temperature)
 
             sample -= (num_text_tokens if is_image else 0) # offset sampled token if it is an image token, since logit space is composed of text and then image tokens
-            out = torch.cat((out, sample), dim=-1)
-
-            if out.shape[1] <= text_seq_len:
-                mask = F.pad(mask, (0, 1), value = True)
+            out[:, cur_len:(cur_len + 1)] = sample
 
         text_seq = out[:, :text_seq_len]
 
@@ -309,48 +362,66 @@ class DALLE(nn.Module):
         text,
         image = None,
         mask = None,
-        return_loss = False
+        return_loss = False,
+        cache = None,
+        return_cache = False
     ):
-        device = text.device
         eos_token_id = self.total_tokens - 1
 
         tokens = self.text_emb(text)
-        tokens += self.text_pos_emb(torch.arange(text.shape[1], device = device))
+        tokens = tokens + self.text_pos_emb.weight[:text.shape[1]]
 
         seq_len = tokens.shape[1]
 
         if exists(image) and not is_empty(image):
             is_raw_image = len(image.shape) == 4
-            image_len = image.shape[1]
-            seq_len += image_len
 
             if is_raw_image:
                 assert exists(self.vae), 'VAE must be passed into constructor if you are to train directly on raw images'
                 image = self.vae.get_codebook_indices(image)
 
+            image_len = image.shape[1]
+            seq_len += image_len
+
             image_emb = self.image_emb(image)
-            image_emb += self.image_pos_emb(torch.arange(image_len, device = device))
+            image_emb = image_emb + self.image_pos_emb.weight[:image_len]
 
             tokens = torch.cat((tokens, image_emb), dim = 1)
 
             if exists(mask):
                 mask = F.pad(mask, (0, image_emb.shape[1]), value = True)
 
-        out = self.transformer(tokens, mask = mask)
+        if return_cache:
+            # with a cache of past keys / values, only the newest position is run through the decoder
+            out, cache = self.transformer(tokens, mask = mask, cache = cache, return_hiddens = True)
+
+            # decoding only ever samples from the last position, so skip projecting (and masking) the prefix
+            out = out[:, -1:]
+        else:
+            out = self.transformer(tokens, mask = mask)
+
         logits = self.to_logits(out)
 
         # mask logits to make sure text predicts text (except last token), and image predicts image
-        mask = self.logits_mask[:, :seq_len]
+        mask = self.logits_mask[:, (seq_len - logits.shape[1]):seq_len]
         max_neg_value = -torch.finfo(logits.dtype).max
         logits.masked_fill_(mask, max_neg_value)
 
+        if return_cache:
+            return logits, cache
+
         if not return_loss:
             return logits
 
         assert exists(image), 'when training, image must be supplied'
 
-        offsetted_image = image + self.num_text_tokens
-        labels = torch.cat((text, offsetted_image), dim = 1)
-        labels = F.pad(labels, (0, 1), value = eos_token_id) # last token predicts EOS
-        loss = F.cross_entropy(logits.transpose(1, 2), labels[:, 1:])
+        # labels are the sequence shifted left by one, written in place - text, offsetted image, then EOS for the last token
+
+        text_len = text.shape[1]
+        labels = text.new_empty((text.shape[0], seq_len))
+        labels[:, :(text_len - 1)] = text[:, 1:]
+        labels[:, (text_len - 1):-1] = image + self.num_text_tokens
+        labels[:, -1] = eos_token_id
+
+        loss = F.cross_entropy(logits.reshape(-1, self.total_tokens), labels.flatten())
         return loss
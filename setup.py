@@ -16,9 +16,8 @@ setup(
     'text-to-image'
   ],
   install_requires=[
-    'einops>=0.3',
     'torch>=1.6',
-    'x-transformers'
+    'x-transformers>=1.30.0'
   ],
   classifiers=[
     'Development Status :: 4 - Beta',